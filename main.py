@@ -9,6 +9,7 @@ from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
     ConversationHandler, ContextTypes, filters
 )
+from persistence import JsonUserPersistence
 
 # Загрузка переменных окружения
 from dotenv import load_dotenv
@@ -28,6 +29,8 @@ DELETE_EVENT, CONFIRM_DELETE = range(6, 8)
 # Файл для хранения данных
 JSON_FILE = 'calendar.json'
 USERS_FILE = 'users.json'
+# Каталог для незавершённых диалогов и user_data
+STATE_DIR = 'state'
 
 # Роли пользователей
 ROLE_USER = 'user'
@@ -541,7 +544,9 @@ def main():
         sys.exit(1)
     
     # Создаем Application с токеном
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Состояние диалогов сохраняется, чтобы после перезапуска продолжить с того же шага
+    persistence = JsonUserPersistence(STATE_DIR)
+    application = Application.builder().token(BOT_TOKEN).persistence(persistence).build()
     
     # Инициализируем файл пользователей
     load_users()
@@ -557,7 +562,9 @@ def main():
             EVENT_PLACE: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_place)],
             EVENT_LINK: [MessageHandler(filters.TEXT & ~filters.COMMAND, event_link)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='add_event',
+        persistent=True
     )
     
     # ConversationHandler для удаления событий
@@ -567,7 +574,9 @@ def main():
             DELETE_EVENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_event)],
             CONFIRM_DELETE: [MessageHandler(filters.Regex('^(Да, удалить|Нет, отменить)$'), confirm_delete_event)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='delete_event',
+        persistent=True
     )
     
     # Добавление обработчиков
@@ -0,0 +1,287 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+USERS_DIR = 'users'
+CONVERSATIONS_DIR = 'conversations'
+
+
+def write_file_atomic(path, text):
+    """Атомарная запись файла: сначала во временный файл, затем замена"""
+    directory, file_name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{file_name}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def read_json_file(path):
+    """Чтение JSON-файла; при ошибке файл пропускается с записью в лог"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        logger.warning("Пропущен файл состояния %s: %s", path, e)
+        return None
+
+
+def list_json_files(directory):
+    """Список JSON-файлов каталога (пустой, если каталога нет)"""
+    try:
+        file_names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    except OSError as e:
+        logger.warning("Не удалось прочитать каталог состояния %s: %s", directory, e)
+        return []
+    return [file_name for file_name in file_names if file_name.endswith('.json')]
+
+
+def write_entries(entries):
+    """Запись пачки файлов: {путь: текст или None для удаления}.
+
+    Возвращает пути, которые записать не удалось.
+    """
+    failed = set()
+    created_dirs = set()
+    for path, text in entries.items():
+        try:
+            if text is None:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            directory = os.path.dirname(path)
+            if directory not in created_dirs:
+                os.makedirs(directory, exist_ok=True)
+                created_dirs.add(directory)
+            write_file_atomic(path, text)
+        except OSError as e:
+            logger.error("Не удалось сохранить состояние в %s: %s", path, e)
+            failed.add(path)
+    return failed
+
+
+class JsonUserPersistence(BasePersistence):
+    """Хранение user_data и состояний ConversationHandler в JSON-файлах.
+
+    Каждый пользователь и каждый активный диалог хранятся в отдельном
+    файле, поэтому при сбросе на диск перезаписываются только изменившиеся
+    записи. Изменения, пришедшие за один проход
+    Application.update_persistence, записываются одной задачей, а сам
+    файловый ввод-вывод выполняется в отдельном потоке.
+    """
+
+    def __init__(self, directory, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.directory = directory
+        self.users_dir = os.path.join(directory, USERS_DIR)
+        self.conversations_dir = os.path.join(directory, CONVERSATIONS_DIR)
+
+        self._user_data = None
+        self._conversations = {}
+        # Последнее записанное на диск представление каждого пользователя
+        self._written_users = {}
+        # Ожидающие записи изменения: {user_id: JSON или None для удаления}
+        self._dirty_users = {}
+        # {(имя диалога, ключ): состояние или None для удаления}
+        self._dirty_conversations = {}
+        self._write_task = None
+
+    def _user_path(self, user_id):
+        return os.path.join(self.users_dir, f"{user_id}.json")
+
+    def _conversation_path(self, name, key):
+        return os.path.join(self.conversations_dir, name, '_'.join(str(part) for part in key) + '.json')
+
+    def _load_users(self):
+        """Загрузка user_data всех пользователей из каталога"""
+        self._user_data = {}
+        for file_name in list_json_files(self.users_dir):
+            user_id_str = file_name[:-len('.json')]
+            if not user_id_str.lstrip('-').isdigit():
+                continue
+            data = read_json_file(os.path.join(self.users_dir, file_name))
+            # Пустые user_data не хранятся; такой файл мог остаться после сбоя
+            if not data:
+                continue
+            user_id = int(user_id_str)
+            self._user_data[user_id] = data
+            self._written_users[user_id] = json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+    def _load_conversations(self, name):
+        """Загрузка состояний диалогов одного ConversationHandler"""
+        conversations = {}
+        name_dir = os.path.join(self.conversations_dir, name)
+        for file_name in list_json_files(name_dir):
+            entry = read_json_file(os.path.join(name_dir, file_name))
+            if not isinstance(entry, dict) or 'key' not in entry or 'state' not in entry:
+                continue
+            # JSON не поддерживает кортежи, поэтому ключ хранится списком
+            conversations[tuple(entry['key'])] = entry['state']
+        self._conversations[name] = conversations
+        return conversations
+
+    def _has_dirty(self):
+        return bool(self._dirty_users or self._dirty_conversations)
+
+    def _schedule_write(self):
+        """Планирует одну запись на диск для всех накопленных изменений"""
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.get_running_loop().create_task(self._write_dirty())
+            self._write_task.add_done_callback(self._on_write_done)
+
+    @staticmethod
+    def _on_write_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Ошибка при сохранении состояния", exc_info=task.exception())
+
+    async def _write_dirty(self):
+        """Запись накопленных изменений; повторяется, пока есть новые"""
+        while self._has_dirty():
+            if not await self._write_batch():
+                # Неудачные записи остались в очереди и будут повторены при следующем сбросе
+                break
+
+    async def _write_batch(self):
+        """Забирает текущие изменения и записывает их в отдельном потоке"""
+        dirty_users, self._dirty_users = self._dirty_users, {}
+        dirty_conversations, self._dirty_conversations = self._dirty_conversations, {}
+
+        entries = {}
+        for user_id, serialized in dirty_users.items():
+            entries[self._user_path(user_id)] = serialized
+        for (name, key), state in dirty_conversations.items():
+            entries[self._conversation_path(name, key)] = (
+                None if state is None
+                else json.dumps({'key': list(key), 'state': state}, ensure_ascii=False)
+            )
+
+        try:
+            failed = await asyncio.to_thread(write_entries, entries)
+        except BaseException:
+            failed = set(entries)
+            raise
+        finally:
+            # Неудачные записи возвращаются в очередь, если их не вытеснило более новое изменение
+            for user_id, serialized in dirty_users.items():
+                if self._user_path(user_id) in failed:
+                    self._dirty_users.setdefault(user_id, serialized)
+                elif serialized is None:
+                    self._written_users.pop(user_id, None)
+                else:
+                    self._written_users[user_id] = serialized
+            for conversation, state in dirty_conversations.items():
+                if self._conversation_path(*conversation) in failed:
+                    self._dirty_conversations.setdefault(conversation, state)
+
+        return not failed
+
+    async def get_user_data(self):
+        if self._user_data is None:
+            self._load_users()
+        return self._user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        conversations = self._conversations.get(name)
+        if conversations is None:
+            conversations = self._load_conversations(name)
+        return dict(conversations)
+
+    async def update_conversation(self, name, key, new_state):
+        conversations = self._conversations.get(name)
+        if conversations is None:
+            conversations = self._load_conversations(name)
+
+        if new_state is None:
+            if key not in conversations:
+                return
+            del conversations[key]
+        elif key in conversations and conversations[key] == new_state:
+            return
+        else:
+            conversations[key] = new_state
+
+        self._dirty_conversations[(name, key)] = new_state
+        self._schedule_write()
+
+    async def update_user_data(self, user_id, data):
+        # Пустые user_data (новый пользователь или после clear()) не храним,
+        # иначе каталог разрастается файлами "{}" для каждого пользователя
+        if not data:
+            if user_id in self._written_users or self._dirty_users.get(user_id) is not None:
+                self._written_users.pop(user_id, None)
+                self._dirty_users[user_id] = None
+                self._schedule_write()
+            return
+
+        # Application помечает пользователя при каждом апдейте, поэтому
+        # сравниваем с последней записанной версией и пропускаем неизменённых
+        serialized = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        if self._written_users.get(user_id) == serialized:
+            self._dirty_users.pop(user_id, None)
+            return
+
+        self._dirty_users[user_id] = serialized
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._written_users.pop(user_id, None)
+        self._dirty_users[user_id] = None
+        self._schedule_write()
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self._write_task is not None and not self._write_task.done():
+            await self._write_task
+        # Повторяем записи, не удавшиеся ранее, через ту же задачу,
+        # чтобы на диск всегда писал только один поток
+        if self._has_dirty():
+            self._schedule_write()
+            await self._write_task
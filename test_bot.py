@@ -1,6 +1,11 @@
 import pytest
+import asyncio
 import json
-from main import validate_date, validate_price, format_price
+import os
+import time
+from main import validate_date, validate_price, format_price, EVENT_PRICE, DELETE_EVENT
+import persistence as persistence_module
+from persistence import JsonUserPersistence
 
 def test_load_events_empty_file(tmp_path):
     """Тест загрузки событий из несуществующего файла"""
@@ -69,6 +74,255 @@ def test_save_and_load_events(tmp_path):
     assert len(loaded_data["events"]) == 1
     assert loaded_data["events"][0]["name"] == "Test Event"
 
+def test_persistence_resume_after_restart(tmp_path):
+    """Тест восстановления незавершённого диалога после перезапуска"""
+    async def run():
+        persistence = JsonUserPersistence(str(tmp_path))
+        await persistence.get_user_data()
+        await persistence.get_conversations('add_event')
+        await persistence.update_user_data(42, {'event': {'name': 'Игра', 'date': '01.01.2025'}})
+        await persistence.update_conversation('add_event', (42, 42), EVENT_PRICE)
+        await persistence.update_conversation('delete_event', (7, 7), DELETE_EVENT)
+        await persistence.flush()
+
+        # Новый экземпляр имитирует перезапуск бота
+        restarted = JsonUserPersistence(str(tmp_path))
+        return (
+            await restarted.get_user_data(),
+            await restarted.get_conversations('add_event'),
+            await restarted.get_conversations('delete_event')
+        )
+
+    user_data, add_conversations, delete_conversations = asyncio.run(run())
+    assert user_data == {42: {'event': {'name': 'Игра', 'date': '01.01.2025'}}}
+    assert add_conversations == {(42, 42): EVENT_PRICE}
+    assert delete_conversations == {(7, 7): DELETE_EVENT}
+
+def snapshot_mtimes(directory):
+    """Время изменения всех файлов каталога состояния"""
+    mtimes = {}
+    for root, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            mtimes[os.path.relpath(path, directory)] = os.stat(path).st_mtime_ns
+    return mtimes
+
+def changed_files(before, after):
+    return {path for path in set(before) | set(after) if before.get(path) != after.get(path)}
+
+def test_persistence_writes_only_dirty_users(tmp_path):
+    """Тест записи на диск только изменившихся пользователей"""
+    async def run():
+        persistence = JsonUserPersistence(str(tmp_path))
+        await persistence.get_user_data()
+        await persistence.update_user_data(1, {'event': {'name': 'A'}})
+        await persistence.update_user_data(2, {'event': {'name': 'B'}})
+        await persistence.flush()
+
+        before = snapshot_mtimes(str(tmp_path))
+        # Пользователь 2 не менялся, пользователь 1 перешёл на следующий шаг
+        time.sleep(0.01)
+        await persistence.update_user_data(1, {'event': {'name': 'A', 'date': '01.01.2025'}})
+        await persistence.update_user_data(2, {'event': {'name': 'B'}})
+        await persistence.flush()
+        changed = changed_files(before, snapshot_mtimes(str(tmp_path)))
+
+        await persistence.drop_user_data(2)
+        await persistence.flush()
+        return changed, sorted(os.listdir(os.path.join(str(tmp_path), 'users')))
+
+    changed, user_files = asyncio.run(run())
+    assert changed == {os.path.join('users', '1.json')}
+    assert user_files == ['1.json']
+
+def test_persistence_flush_writes_only_changed_entries(tmp_path):
+    """Тест: изменение одного пользователя не перезаписывает состояния остальных"""
+    async def run():
+        persistence = JsonUserPersistence(str(tmp_path))
+        await persistence.get_user_data()
+        await persistence.get_conversations('add_event')
+        for user_id in range(10):
+            await persistence.update_user_data(user_id, {'event': {'name': f'Событие {user_id}'}})
+            await persistence.update_conversation('add_event', (user_id, user_id), EVENT_PRICE)
+        await persistence.flush()
+
+        before = snapshot_mtimes(str(tmp_path))
+        time.sleep(0.01)
+        await persistence.update_user_data(5, {'event': {'name': 'Событие 5', 'price': '500 рублей'}})
+        await persistence.update_conversation('add_event', (5, 5), EVENT_PRICE + 1)
+        await persistence.update_conversation('add_event', (6, 6), None)
+        await persistence.flush()
+        return changed_files(before, snapshot_mtimes(str(tmp_path)))
+
+    assert asyncio.run(run()) == {
+        os.path.join('users', '5.json'),
+        os.path.join('conversations', 'add_event', '5_5.json'),
+        os.path.join('conversations', 'add_event', '6_6.json'),
+    }
+
+def test_persistence_skips_broken_files(tmp_path):
+    """Тест: повреждённые файлы состояния не мешают запуску"""
+    users_dir = tmp_path / 'users'
+    users_dir.mkdir()
+    (users_dir / '1.json').write_bytes(b'\xff\xfe{')
+    (users_dir / '2.json').write_text('{"event": {"name": "A"}}', encoding='utf-8')
+    conversations_dir = tmp_path / 'conversations' / 'add_event'
+    conversations_dir.mkdir(parents=True)
+    (conversations_dir / '1_1.json').write_text('{"key": [1, 1', encoding='utf-8')
+
+    async def run():
+        persistence = JsonUserPersistence(str(tmp_path))
+        return await persistence.get_user_data(), await persistence.get_conversations('add_event')
+
+    assert asyncio.run(run()) == ({2: {'event': {'name': 'A'}}}, {})
+
+def test_persistence_retries_failed_writes(tmp_path, monkeypatch):
+    """Тест: при ошибке записи изменения не теряются и сохраняются при следующем сбросе"""
+    original_write = persistence_module.write_file_atomic
+
+    def failing_write(path, text):
+        if path.endswith('1.json'):
+            raise OSError("No space left on device")
+        original_write(path, text)
+
+    async def run():
+        persistence = JsonUserPersistence(str(tmp_path))
+        await persistence.get_user_data()
+        await persistence.get_conversations('add_event')
+        await persistence.update_user_data(1, {'event': {'name': 'A'}})
+        await persistence.update_user_data(2, {'event': {'name': 'B'}})
+        await persistence.update_conversation('add_event', (1, 1), EVENT_PRICE)
+
+        monkeypatch.setattr(persistence_module, 'write_file_atomic', failing_write)
+        await persistence.flush()
+        written_after_failure = snapshot_mtimes(str(tmp_path)).keys()
+
+        monkeypatch.setattr(persistence_module, 'write_file_atomic', original_write)
+        await persistence.flush()
+        return written_after_failure, snapshot_mtimes(str(tmp_path)).keys()
+
+    written_after_failure, written_after_retry = asyncio.run(run())
+    assert written_after_failure == {os.path.join('users', '2.json')}
+    assert written_after_retry == {
+        os.path.join('users', '1.json'),
+        os.path.join('users', '2.json'),
+        os.path.join('conversations', 'add_event', '1_1.json'),
+    }
+
+def test_persistence_update_during_retry_is_not_lost(tmp_path, monkeypatch):
+    """Тест: изменение во время повторной записи сохраняется поверх старого"""
+    original_write = persistence_module.write_file_atomic
+
+    def failing_write(path, text):
+        raise OSError("No space left on device")
+
+    async def run():
+        persistence = JsonUserPersistence(str(tmp_path))
+        await persistence.get_user_data()
+        await persistence.update_user_data(1, {'v': 'A'})
+        monkeypatch.setattr(persistence_module, 'write_file_atomic', failing_write)
+        await persistence.flush()
+        monkeypatch.setattr(persistence_module, 'write_file_atomic', original_write)
+
+        flush_task = asyncio.create_task(persistence.flush())
+        await asyncio.sleep(0)
+        await persistence.update_user_data(1, {'v': 'B'})
+        await flush_task
+        await persistence.flush()
+
+        with open(os.path.join(str(tmp_path), 'users', '1.json'), encoding='utf-8') as f:
+            return json.load(f), os.listdir(os.path.join(str(tmp_path), 'users'))
+
+    data, user_files = asyncio.run(run())
+    assert data == {'v': 'B'}
+    assert user_files == ['1.json']
+
+def test_persistence_skips_empty_user_data(tmp_path):
+    """Тест: для пустых user_data файлы не создаются, после clear() файл удаляется"""
+    async def run():
+        persistence = JsonUserPersistence(str(tmp_path))
+        await persistence.get_user_data()
+        # Пользователь только нажал /start
+        await persistence.update_user_data(1, {})
+        await persistence.update_user_data(2, {'event': {'name': 'A'}})
+        await persistence.flush()
+        files_before_clear = sorted(snapshot_mtimes(str(tmp_path)))
+
+        # Событие добавлено, context.user_data.clear()
+        await persistence.update_user_data(2, {})
+        await persistence.flush()
+        return files_before_clear, sorted(snapshot_mtimes(str(tmp_path)))
+
+    files_before_clear, files_after_clear = asyncio.run(run())
+    assert files_before_clear == [os.path.join('users', '2.json')]
+    assert files_after_clear == []
+
+def test_persistence_update_overhead(tmp_path):
+    """Бенчмарк: накладные расходы хранения укладываются в бюджет.
+
+    Бюджеты заданы кратными базовых замеров в том же запуске, чтобы тест
+    не зависел от скорости машины и диска.
+    """
+    users_count = 300
+    steps = 3
+    update_budget_factor = 10  # относительно сериализации user_data
+    flush_budget_factor = 20  # относительно прямой атомарной записи тех же файлов
+
+    def make_data(user_id, step):
+        return {'event': {'name': f'Событие {user_id}', 'step': step}}
+
+    # Базовая линия: только сериализация user_data
+    start = time.perf_counter()
+    for step in range(steps):
+        for user_id in range(users_count):
+            json.dumps(make_data(user_id, step), ensure_ascii=False, sort_keys=True)
+    baseline_update = time.perf_counter() - start
+
+    # Базовая линия: атомарная запись тех же файлов без какой-либо логики
+    baseline_dir = tmp_path / 'baseline'
+    baseline_dir.mkdir()
+    start = time.perf_counter()
+    for step in range(steps):
+        for user_id in range(users_count):
+            persistence_module.write_file_atomic(
+                str(baseline_dir / f'{user_id}.json'), json.dumps(make_data(user_id, step)))
+            persistence_module.write_file_atomic(
+                str(baseline_dir / f'{user_id}_{user_id}.json'), json.dumps({'key': [user_id, user_id], 'state': step}))
+    baseline_flush = time.perf_counter() - start
+
+    async def run():
+        persistence = JsonUserPersistence(str(tmp_path / 'state'))
+        await persistence.get_user_data()
+        await persistence.get_conversations('add_event')
+
+        update_time = 0
+        flush_time = 0
+        ticks_during_flush = []
+        for step in range(steps):
+            start = time.perf_counter()
+            for user_id in range(users_count):
+                await persistence.update_user_data(user_id, make_data(user_id, step))
+                await persistence.update_conversation('add_event', (user_id, user_id), step)
+            update_time += time.perf_counter() - start
+
+            # Пока идёт запись, цикл событий должен продолжать выполнять другие корутины
+            start = time.perf_counter()
+            flush_task = asyncio.create_task(persistence.flush())
+            ticks = 0
+            while not flush_task.done():
+                ticks += 1
+                await asyncio.sleep(0)
+            await flush_task
+            flush_time += time.perf_counter() - start
+            ticks_during_flush.append(ticks)
+        return update_time, flush_time, ticks_during_flush
+
+    update_time, flush_time, ticks_during_flush = asyncio.run(run())
+    assert update_time < baseline_update * update_budget_factor
+    assert flush_time < baseline_flush * flush_budget_factor
+    # Блокирующий сброс завершился бы за один шаг цикла
+    assert all(ticks > 1 for ticks in ticks_during_flush)
+
 def test_example():
     """Простой тест для проверки работы pytest"""
     assert True